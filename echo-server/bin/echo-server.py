@@ -1,13 +1,72 @@
-import socketserver
+import argparse
+import selectors
+import socket
 
-class EchoTCPHandler(socketserver.BaseRequestHandler):
-    def handle(self):
-        self.data = self.request.recv(1024).strip()
-        print("{} wrote:".format(self.client_address[0]))
-        print(self.data, flush=True)
-        self.request.sendall(self.data)
+def send_some(conn, data):
+    try:
+        return conn.send(data)
+    except BlockingIOError:
+        return 0
+
+def serve(host, port, verbose=False):
+    sel = selectors.DefaultSelector()
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen()
+    sock.setblocking(False)
+    sel.register(sock, selectors.EVENT_READ)
+    buf = bytearray(65536)
+    view = memoryview(buf)
+    # Unsent echo data for clients that aren't keeping up. They are not read
+    # from again until it has gone, so one slow client can't block the rest.
+    pending = {}
+    while True:
+        for key, mask in sel.select():
+            if key.fileobj is sock:
+                try:
+                    conn, addr = sock.accept()
+                except BlockingIOError:
+                    continue
+                conn.setblocking(False)
+                conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                sel.register(conn, selectors.EVENT_READ, addr)
+                continue
+            conn, addr = key.fileobj, key.data
+            try:
+                if mask & selectors.EVENT_WRITE:
+                    data = pending.pop(conn)
+                    sent = send_some(conn, data)
+                    if sent < len(data):
+                        pending[conn] = data[sent:]
+                    else:
+                        sel.modify(conn, selectors.EVENT_READ, addr)
+                    continue
+                try:
+                    n = conn.recv_into(buf)
+                except BlockingIOError:
+                    # Spurious wakeup; nothing to read after all.
+                    continue
+                if not n:
+                    raise ConnectionError
+                if verbose:
+                    print("{} wrote:".format(addr[0]))
+                    print(bytes(view[:n]), flush=True)
+                sent = send_some(conn, view[:n])
+                if sent < n:
+                    pending[conn] = bytes(view[sent:n])
+                    sel.modify(conn, selectors.EVENT_WRITE, addr)
+            except OSError:
+                # Client closed or went away; carry on with the others.
+                pending.pop(conn, None)
+                sel.unregister(conn)
+                conn.close()
 
 if __name__ == "__main__":
-    HOST, PORT = "0.0.0.0", 7
-    server = socketserver.TCPServer((HOST, PORT), EchoTCPHandler)
-    server.serve_forever()
+    parser = argparse.ArgumentParser(description="TCP echo server.")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=7)
+    parser.add_argument("-v", "--verbose", action="store_true",
+                        help="Print received data.")
+    args = parser.parse_args()
+    serve(args.host, args.port, args.verbose)
@@ -8,7 +8,7 @@ Can be used in two modes:
 The transmission is reasonably low-latency - you can expect 10's to 100's of
 milliseconds, depending on your network.
 
-Requires pyaudio.
+Requires pyaudio, and numpy for --gain.
 
 Credits:
   * Inspired by Mark Hills' trx; http://www.pogo.org.uk/~mark/trx/
@@ -16,25 +16,53 @@ Credits:
     http://sharewebegin.blogspot.com/2013/06/real-time-voice-chat-example-in-python.html
 """
 import argparse
-import errno
+import asyncio
+import atexit
 import logging
+import os
 import pyaudio
+import queue
 import signal
 import socket
 import sys
 import time
 import wave
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Most buffers a single sendmsg will gather.
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = -1
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
 
 class BaseAudio(object):
     audio = None
     sock = None
     stream = None
+    width = 2
+    # Socket buffers hold this many chunks, so a stalled peer applies
+    # backpressure quickly instead of queueing up latency.
+    sock_buffer_chunks = 4
+    # Chunks queued between the audio callback and the socket before new
+    # ones are dropped.
+    queue_chunks = 4
 
     def __init__(self, duration=None, channels=1, rate=44100,
                  chunk_size=1024, host='', port=50007, device_index=None,
-                 sock_timeout=1.0):
+                 sock_timeout=1.0, coalesce=1, gain=1.0, audio_frames=128):
         self.chunk_size = chunk_size
+        self.audio_frames = audio_frames
+        # Audio device buffers per network chunk.
+        self.buffers_per_chunk = chunk_size // audio_frames
+        self.gain = gain
+        self.coalesce = coalesce
         self.channels = channels
         self.device_index = device_index
         self.duration = duration
@@ -43,20 +71,30 @@ class BaseAudio(object):
         self.port = port
         self.format = pyaudio.paInt16
         self.audio = pyaudio.PyAudio()
+        # Looked up once rather than through PortAudio on every stream open.
+        self._fmt = self.audio.get_format_from_width(self.width)
+        self._sample_size = self.audio.get_sample_size(self.format)
+        self.chunk_bytes = chunk_size * channels * self._sample_size
+        self.audio_bytes = audio_frames * channels * self._sample_size
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        # Push each chunk out immediately rather than letting Nagle hold it.
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        bufbytes = self.chunk_bytes * max(self.sock_buffer_chunks, self.coalesce)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_SNDBUF, bufbytes)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, bufbytes)
         self.sock.settimeout(sock_timeout)
         self.log = logging.getLogger(self.__class__.__name__)
+        if audio_frames < 64:
+            self.log.warning("Audio buffers of %d frames are likely to under/overrun" % audio_frames)
+        # Clean up once on the way out, however we get there.
+        atexit.register(self.shutdown)
 
     def list_devices(self):
-        devinfos = []
-        default_devinfo = self.audio.get_default_output_device_info()
+        default_index = self.audio.get_default_output_device_info().get('index')
         for i in range(self.audio.get_device_count()):
-            devinfos.append(self.audio.get_device_info_by_index(i))
-        for i, devinfo in enumerate(devinfos):
+            devinfo = self.audio.get_device_info_by_index(i)
             def_string = ""
-            if devinfo.get('index') != None and \
-                    default_devinfo.get('index') != None and \
-                    devinfo['index'] == default_devinfo['index']:
+            if default_index is not None and devinfo.get('index') == default_index:
                 def_string = " (DEFAULT)"
             print("%d: %s%s" % (i, devinfo.get('name', '?'), def_string))
             print("    Default sample rate: %d" % devinfo.get('defaultSampleRate', 0))
@@ -65,71 +103,152 @@ class BaseAudio(object):
                   devinfo.get('maxOutputChannels', 0)))
 
     def shutdown(self):
+        atexit.unregister(self.shutdown)
+        if not (self.stream or self.audio or self.sock):
+            return
         self.log.info("Shutting down")
         if self.stream:
             self.stream.stop_stream()
             self.stream.close()
+            self.stream = None
         if self.audio:
             self.audio.terminate()
+            self.audio = None
         if self.sock:
             self.sock.close()
+            self.sock = None
 
     def handle_signal(self, signum, frame=None):
         self.log.warning("Received signal %d" % signum)
-        self.shutdown()
+        # Unwind from wherever we were; shutdown runs at exit.
+        sys.exit(0)
+
+
+class RingBuffer(object):
+    """ Single-producer/single-consumer ring of fixed-size slots.
+
+    The producer fills write_slot() and calls commit(); the consumer reads
+    read_slot() and calls release(). Each side only ever stores to its own
+    index, so neither needs a lock. One slot is always kept free so the
+    producer never writes into the slot being read.
+    """
+
+    def __init__(self, capacity, slot_size):
+        self.slots = capacity + 1
+        buf = memoryview(bytearray(self.slots * slot_size))
+        self.views = [buf[i * slot_size:(i + 1) * slot_size]
+                      for i in range(self.slots)]
+        self.head = 0  # Next slot to read; only the consumer advances it.
+        self.tail = 0  # Next slot to write; only the producer advances it.
+
+    def __len__(self):
+        return (self.tail - self.head) % self.slots
+
+    def full(self):
+        return len(self) == self.slots - 1
+
+    def write_slot(self):
+        return self.views[self.tail]
+
+    def commit(self):
+        self.tail = (self.tail + 1) % self.slots
+
+    def read_slot(self):
+        return self.views[self.head]
+
+    def release(self):
+        self.head = (self.head + 1) % self.slots
 
 
 class AudioReceiver(BaseAudio):
-    width = 2
     wf = None
-
-    def open_audio_stream(self):
-        self.stream = self.audio.open(format=self.audio.get_format_from_width(self.width),
-                                      channels=self.channels,
-                                      rate=self.rate,
-                                      output=True,
-                                      output_device_index=self.device_index,
-                                      frames_per_buffer=self.chunk_size)
+    silence = None
+    loop = None
+    main_task = None
+    server = None
+    connections = None
+
+    def open_audio_stream(self, ring):
+        """ Open an output stream that plays chunks from the ring buffer,
+        one audio buffer at a time. """
+        if self.silence is None:
+            self.silence = bytes(self.audio_bytes)
+        silence = self.silence
+        audio_bytes = self.audio_bytes
+        chunk_bytes = self.chunk_bytes
+        offset = 0
+
+        def playback_callback(in_data, frame_count, time_info, status):
+            # Play the next part of the oldest received chunk, or silence if
+            # none is ready.
+            nonlocal offset
+            if not ring:
+                return (silence, pyaudio.paContinue)
+            # PyAudio's callback only accepts bytes.
+            data = bytes(ring.read_slot()[offset:offset + audio_bytes])
+            offset += audio_bytes
+            if offset == chunk_bytes:
+                offset = 0
+                ring.release()
+            return (data, pyaudio.paContinue)
+
+        return self.audio.open(format=self._fmt,
+                               channels=self.channels,
+                               rate=self.rate,
+                               output=True,
+                               output_device_index=self.device_index,
+                               frames_per_buffer=self.audio_frames,
+                               stream_callback=playback_callback)
 
     def listen_and_process(self):
-        """ Listen for a socket connection and then receive audio. """
+        """ Listen for socket connections and receive audio from each. """
         self.sock.bind((self.host, self.port))
-        self.sock.listen(1)
+        self.sock.listen(5)
+        self.sock.setblocking(False)
+        try:
+            asyncio.run(self.accept_connections())
+        except asyncio.CancelledError:
+            pass
+
+    async def accept_connections(self):
+        """ Accept connections and start receiving audio from each of them,
+        waking only when a connection or data arrives. """
+        self.loop = asyncio.get_running_loop()
+        self.main_task = asyncio.current_task()
+        # Signals wake the selector through its wakeup fd and are handled
+        # on the loop, rather than interrupting whatever it was doing.
+        for signum in (signal.SIGINT, signal.SIGTERM):
+            self.loop.add_signal_handler(signum, self.handle_signal, signum)
+        self.connections = set()
+
+        def protocol_factory():
+            return AudioProtocol(self, self.connections)
+
+        self.server = await self.loop.create_server(protocol_factory, sock=self.sock)
         self.log.info("Waiting for new connection...")
-        while True:
-            try:
-                conn, addr = self.sock.accept()
-            except socket.timeout:
-                continue
-            except socket.error as e:
-                if e.errno == errno.EINTR:
-                    # Interrupted system call - we're probably shutting down.
-                    break
-            self.log.info("New connection from %s" % str(addr))
-            self.receive_audio(conn)
-
-    def receive_audio(self, conn):
-        """ Process audio received from a socket connection. """
-        self.log.info("Receiving audio...")
-        frame_count = 1
-        self.open_audio_stream()
-        data = conn.recv(1024)
-        while data != '':
-            self.stream.write(data)
-            data = conn.recv(1024)
-            self.log.debug("Frame %d" % frame_count)
-            frame_count += 1
-            if self.wf:
-                # If list of frames then write like wf.writeframes(b''.join(frames))
-                wf.writeframes(data)
-        self.log.info("Data stopped.")
-        self.stream.stop_stream()
-        self.stream.close()
+        try:
+            await self.server.serve_forever()
+        finally:
+            self.close_connections()
+
+    def close_connections(self):
+        """ Stop accepting and drop every open connection. """
+        if self.server:
+            self.server.close()
+        for connection in list(self.connections or ()):
+            connection.transport.close()
+
+    def handle_signal(self, signum, frame=None):
+        self.log.warning("Received signal %d" % signum)
+        # Since Python 3.12.1, cancelling serve_forever() waits for every
+        # connection to drop, so drop them first.
+        self.close_connections()
+        self.main_task.cancel()
 
     def open_wave_file(self, filename=''):
         self.wf = wave.open(filename, 'wb')
         self.wf.setnchannels(self.channels)
-        self.wf.setsampwidth(self.audio.get_sample_size(self.format))
+        self.wf.setsampwidth(self._sample_size)
         self.wf.setframerate(self.rate)
 
     def close_wave_file(self):
@@ -137,29 +256,170 @@ class AudioReceiver(BaseAudio):
             self.wf.close()
 
 
+class AudioProtocol(asyncio.BufferedProtocol):
+    """ Receives audio from one sender connection and plays it.
+
+    The transport keeps the connection registered with the event loop for
+    its whole lifetime and reads straight into the ring slot that playback
+    will consume, so there's no per-read selector registration, bytes
+    allocation or intermediate copy.
+    """
+    transport = None
+    stream = None
+    quickack_sock = None
+
+    def __init__(self, receiver, connections):
+        self.receiver = receiver
+        self.connections = connections
+        self.log = receiver.log
+        self.debug = self.log.isEnabledFor(logging.DEBUG)
+        self.frame_count = 1
+        self.chunk_bytes = receiver.chunk_bytes
+        self.offset = 0
+        self.ring = RingBuffer(receiver.queue_chunks, receiver.chunk_bytes)
+        self.samples = None
+        if receiver.gain != 1.0:
+            # Zero-copy int16 views of each ring slot, scaled in place via a
+            # float scratch array so there's no allocation per chunk.
+            self.samples = [numpy.frombuffer(view, dtype=numpy.int16)
+                            for view in self.ring.views]
+            self.scratch = numpy.empty(len(self.samples[0]), dtype=numpy.float32)
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.connections.add(self)
+        self.log.info("New connection from %s" % str(transport.get_extra_info('peername')))
+        conn = transport.get_extra_info('socket')
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        if hasattr(socket, 'TCP_QUICKACK'):
+            # Linux only; ACK immediately rather than delaying. The kernel
+            # soon drops back to delayed ACKs, so it's re-armed per chunk.
+            self.quickack_sock = conn
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        try:
+            self.stream = self.receiver.open_audio_stream(self.ring)
+        except OSError as e:
+            # e.g. a hw device that is already playing another sender.
+            self.log.error("Cannot open audio stream: %s" % e)
+            transport.close()
+            return
+        self.log.info("Receiving audio...")
+
+    def get_buffer(self, sizehint):
+        # Receive into the ring's free slot, which playback never reads from
+        # even when the ring is full. Only ask for the rest of the chunk: the
+        # playback callback must be handed whole chunks, as returning fewer
+        # frames than requested would end the stream.
+        slot = self.ring.write_slot()
+        return slot[self.offset:] if self.offset else slot
+
+    def buffer_updated(self, nbytes):
+        self.offset += nbytes
+        if self.offset < self.chunk_bytes:
+            return
+        self.offset = 0
+        if self.quickack_sock:
+            self.quickack_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_QUICKACK, 1)
+        ring = self.ring
+        if self.samples is not None:
+            self.apply_gain(self.samples[ring.tail])
+        if self.debug:
+            self.log.debug("Frame %d", self.frame_count)
+            self.frame_count += 1
+        if self.receiver.wf:
+            self.receiver.wf.writeframes(ring.write_slot())
+        if ring.full():
+            # Playback has fallen behind; drop this chunk rather than add
+            # latency. The slot is simply reused for the next one.
+            return
+        ring.commit()
+
+    def apply_gain(self, samples):
+        """ Scale a received chunk by the receiver's gain, clipping rather
+        than wrapping on overflow. """
+        scratch = self.scratch
+        numpy.multiply(samples, self.receiver.gain, out=scratch)
+        numpy.clip(scratch, -32768, 32767, out=scratch)
+        numpy.copyto(samples, scratch, casting='unsafe')
+
+    def connection_lost(self, exc):
+        self.log.info("Data stopped.")
+        self.connections.discard(self)
+        if self.stream:
+            self.stream.stop_stream()
+            self.stream.close()
+
+
 class AudioSender(BaseAudio):
+    frames = None
+
     def socket_connect(self):
         self.sock.connect((self.host, self.port))
 
     def open_audio_stream(self):
+        self.frames = queue.Queue(maxsize=self.queue_chunks * self.buffers_per_chunk)
         self.stream = self.audio.open(format=self.format,
                                       channels=self.channels,
                                       rate=self.rate,
                                       input=True,
                                       input_device_index=self.device_index,
-                                      frames_per_buffer=self.chunk_size)
+                                      frames_per_buffer=self.audio_frames,
+                                      stream_callback=self.capture_callback)
 
-    def send_frame(self):
-        data = self.stream.read(self.chunk_size)
-        self.sock.sendall(data)
+    def capture_callback(self, in_data, frame_count, time_info, status):
+        """ Queue captured audio for sending, dropping it if the network
+        has fallen behind. """
+        try:
+            self.frames.put_nowait(in_data)
+        except queue.Full:
+            pass
+        return (None, pyaudio.paContinue)
+
+    def send_buffers(self, buffers):
+        """ Send a list of buffers as one gathered write, without joining
+        them into a new bytes first. """
+        sendmsg = self.sock.sendmsg
+        i = 0
+        count = len(buffers)
+        while i < count:
+            sent = sendmsg(buffers[i:i + IOV_MAX])
+            # Skip whatever went out in full and trim a partial send.
+            while i < count and sent >= len(buffers[i]):
+                sent -= len(buffers[i])
+                i += 1
+            if sent:
+                buffers[i] = memoryview(buffers[i])[sent:]
+
+    def send_frame(self, limit=None):
+        """ Send the next `coalesce` chunks of captured audio buffers, along
+        with any backlog (up to limit buffers in total) that queued up behind
+        them. Returns the number of buffers sent. """
+        frames = self.frames
+        get = frames.get
+        count = self.coalesce * self.buffers_per_chunk
+        if limit is not None:
+            count = min(count, limit)
+        buffers = [get() for i in range(count)]
+        # This is the only consumer, so the backlog can't shrink under us.
+        backlog = frames.qsize()
+        if limit is not None:
+            backlog = min(backlog, limit - count)
+        if backlog > 0:
+            get = frames.get_nowait
+            buffers.extend(get() for i in range(backlog))
+        self.send_buffers(buffers)
+        return count + max(backlog, 0)
 
     def send_frames_continuously(self):
+        send_frame = self.send_frame
         while True:
-            self.send_frame()
+            send_frame()
 
     def send_frames_with_time_limit(self, duration):
-        for i in range(0, int(self.rate / self.chunk_size * duration)):
-            self.send_frame()
+        send_frame = self.send_frame
+        remaining = self.rate * duration // self.chunk_size * self.buffers_per_chunk
+        while remaining > 0:
+            remaining -= send_frame(remaining)
 
     def start_sending(self):
         self.log.info("Opening socket connection")
@@ -196,7 +456,10 @@ if __name__ == '__main__':
                        help="Sample rate of audio in Hz. Default %(default)s.")
     audio.add_argument("--chunk-size", dest="chunk_size", action="store",
                        type=int, metavar="FRAMES", default=1024,
-                       help="Frames per buffer. Default %(default)s.")
+                       help="Frames per network write. Default %(default)s.")
+    audio.add_argument("--audio-frames", dest="audio_frames", action="store",
+                       type=int, metavar="FRAMES", default=128,
+                       help="Frames per audio device buffer; lower means less latency. Must divide --chunk-size. Default %(default)s.")
     audio.add_argument("--channels", dest="channels", action="store",
                        type=int, metavar="QTY", default=1,
                        help="Number of audio channels. Default %(default)s.")
@@ -204,10 +467,18 @@ if __name__ == '__main__':
                        type=int, metavar="ID", default=None,
                        help="Audio device ID. Use --list to list available devices. If none then assume default ALSA device.")
 
+    receiver = parser.add_argument_group("Receiver-specific audio options")
+    receiver.add_argument("--gain", dest="gain", action="store",
+                          type=float, metavar="FACTOR", default=1.0,
+                          help="Scale received audio by this factor (requires numpy). Default %(default)s.")
+
     sender = parser.add_argument_group("Sender-specific audio options")
     sender.add_argument("--duration", dest="duration", action="store",
                         type=int, metavar="SECS", default=0,
                         help="Max duration of audio to capture and send. Default 0 (unlimited).")
+    sender.add_argument("--coalesce", dest="coalesce", action="store",
+                        type=int, metavar="CHUNKS", default=1,
+                        help="Chunks to send per write. Higher values use less CPU but add latency. Default %(default)s.")
 
     network = parser.add_argument_group("Network options")
     network.add_argument("--host", dest="host", action="store",
@@ -218,7 +489,7 @@ if __name__ == '__main__':
                          help="TCP port number. Default %(default)s.")
     network.add_argument("--timeout", dest="sock_timeout", action="store",
                          type=float, metavar="SECS", default=1.0,
-                         help="TCP socket timeout in secs. Default %(default)s.")
+                         help="Sender: TCP socket timeout in secs. Default %(default)s.")
 
     parser.add_argument("--log", dest="logfile", action="store",
                         type=str, metavar="FILENAME", default="",
@@ -229,6 +500,10 @@ if __name__ == '__main__':
                         help="Log debug messages also.")
 
     args = parser.parse_args()
+    if args.gain != 1.0 and numpy is None:
+        parser.error("--gain requires numpy")
+    if args.audio_frames <= 0 or args.chunk_size % args.audio_frames:
+        parser.error("--audio-frames must divide --chunk-size")
 
     # Setup the root logger
     log = logging.getLogger()
@@ -264,11 +539,13 @@ if __name__ == '__main__':
                     host=args.host,
                     port=args.port,
                     device_index=args.device_index,
-                    sock_timeout=args.sock_timeout)
+                    sock_timeout=args.sock_timeout,
+                    coalesce=args.coalesce,
+                    audio_frames=args.audio_frames)
             signal.signal(signal.SIGINT, tx.handle_signal)
             signal.signal(signal.SIGTERM, tx.handle_signal)
             tx.start_sending()
-            tx.stop_senddng()
+            tx.stop_sending()
         except KeyboardInterrupt:
             tx.log.warning("Received KeyboardInterrupt")
             tx.stop_sending()
@@ -281,10 +558,11 @@ if __name__ == '__main__':
                     host=args.host,
                     port=args.port,
                     device_index=args.device_index,
-                    sock_timeout=args.sock_timeout)
-            signal.signal(signal.SIGINT, rx.handle_signal)
-            signal.signal(signal.SIGTERM, rx.handle_signal)
+                    sock_timeout=args.sock_timeout,
+                    gain=args.gain,
+                    audio_frames=args.audio_frames)
             rx.listen_and_process()
+            rx.shutdown()
         except KeyboardInterrupt:
             rx.log.warning("Received KeyboardInterrupt")
             rx.shutdown()